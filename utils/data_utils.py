@@ -2,4 +2,95 @@ import numpy as np
 import os
 import glob
 
+from monai.data import DataLoader, PersistentDataset, load_decathlon_datalist
+from monai.data.utils import pickle_hashing
+from monai.transforms import (Compose,
+                              LoadImaged,
+                              EnsureChannelFirstd,
+                              Orientationd,
+                              Spacingd,
+                              ScaleIntensityRanged,
+                              CropForegroundd,
+                              SpatialPadd,
+                              RandSpatialCropSamplesd,
+                              ToTensord)
+from typing import *
 
+
+def get_deterministic_transforms(pixdim: Sequence[float]=(1.5, 1.5, 2.0),
+                                 a_min: float=-1000.0,
+                                 a_max: float=1000.0,
+                                 roi_size: Sequence[int]=(96, 96, 96)) -> Compose:
+    """Transforms that give the same result for a volume every epoch.
+
+    The volume is loaded (the NIFTI scl_slope/scl_inter are applied by
+    nibabel), resampled to pixdim, scaled from [a_min, a_max] to [0, 1]
+    and cropped to the foreground, then padded to at least roi_size.
+    """
+    return Compose([
+        LoadImaged(keys=["image"]),
+        EnsureChannelFirstd(keys=["image"]),
+        Orientationd(keys=["image"], axcodes="RAS"),
+        Spacingd(keys=["image"], pixdim=pixdim, mode="bilinear"),
+        ScaleIntensityRanged(keys=["image"], a_min=a_min, a_max=a_max,
+                             b_min=0.0, b_max=1.0, clip=True),
+        CropForegroundd(keys=["image"], source_key="image"),
+        SpatialPadd(keys=["image"], spatial_size=roi_size),
+    ])
+
+
+def get_random_transforms(roi_size: Sequence[int]=(96, 96, 96),
+                          num_samples: int=2) -> Compose:
+    """Transforms that are randomized each time a volume is used.
+    """
+    return Compose([
+        RandSpatialCropSamplesd(keys=["image"], roi_size=roi_size,
+                                num_samples=num_samples, random_size=False),
+        ToTensord(keys=["image"]),
+    ])
+
+
+def get_loader(json_path: str,
+               data_dir: str="./",
+               cache_dir: str="./cache",
+               data_list_key: str="training",
+               batch_size: int=1,
+               num_workers: int=4,
+               roi_size: Sequence[int]=(96, 96, 96),
+               num_samples: int=2,
+               pixdim: Sequence[float]=(1.5, 1.5, 2.0),
+               a_min: float=-1000.0,
+               a_max: float=1000.0) -> DataLoader:
+    """Create a DataLoader for a JSON file from save_nifti_to_json.
+
+    The output of the deterministic transforms is cached as tensors in
+    cache_dir by PersistentDataset, so after the first epoch the volumes
+    are not decompressed and resampled again, only the random crops are
+    computed for each epoch.  The cache key includes the parameters of
+    the deterministic transforms (pixdim, a_min, a_max, roi_size), so
+    the same cache_dir can be used with different parameters.
+    """
+    datalist = load_decathlon_datalist(json_path, False, data_list_key,
+                                       base_dir=data_dir)
+
+    # PersistentDataset caches the results of the transforms up to the
+    # first random one, so the two lists are joined into one Compose
+    # (a nested Compose would count as random and nothing would be cached)
+    deterministic = get_deterministic_transforms(pixdim=pixdim, a_min=a_min,
+                                                 a_max=a_max,
+                                                 roi_size=roi_size)
+    randomized = get_random_transforms(roi_size=roi_size,
+                                       num_samples=num_samples)
+    transforms = Compose(deterministic.transforms + randomized.transforms)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # hash_transform adds a hash of the pickled deterministic transforms
+    # to the cache key, which is otherwise only the image path
+    # (json_hashing cannot serialize the transforms, and would only
+    # hash their class names)
+    dataset = PersistentDataset(data=datalist, transform=transforms,
+                                cache_dir=cache_dir,
+                                hash_transform=pickle_hashing)
+
+    return DataLoader(dataset, batch_size=batch_size, shuffle=True,
+                      num_workers=num_workers)
@@ -6,6 +6,10 @@
 """
 
 import pydicom
+import pydicom.datadict
+import pydicom.errors
+import pydicom.filereader
+import pydicom.uid
 import nibabel as nib
 import numpy as np
 from typing import *
@@ -13,9 +17,20 @@ from typing import *
 import json
 import random
 import argparse
-import glob
 import sys
 import os
+import io
+import functools
+import collections
+import shutil
+import subprocess
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+                                as_completed)
+
+try:
+    import liburing
+except ImportError:
+    liburing = None
 
 usage="""
 Convert DICOM (MRI) files to NIFTI:
@@ -28,73 +43,275 @@ Convert DICOM (MRI) files to NIFTI:
   You can use either ".nii" or ".nii.gz" as the suffix for the
   nifti files (use .nii.gz to write compressed files).
 
-  The output nifti file will be float32 (single precision).
+  The output nifti file keeps the stored pixel type of the DICOM files
+  (e.g. int16 for CT), with the rescale slope and intercept written to
+  the nifti header.  If the rescale differs between slices, the output
+  will be float32 (single precision) instead.
+
+  If the liburing module is installed, set DICOM_USE_IO_URING=1 to
+  read the DICOM files with io_uring instead of with ordinary reads.
+
+  If the numba module is installed, set DICOM_USE_NUMBA=1 to compute
+  the affine matrices with numba.  This only pays off when many series
+  are converted by one process, since importing numba and loading the
+  compiled code takes about 0.3 seconds.
 """
 
+# file suffixes (in lower case) that are recognized as DICOM
+DICOM_SUFFIXES = (".dcm", ".dc", ".img")
+
+# the InstanceNumber tag, (0020,0013)
+INSTANCE_NUMBER_TAG = 0x00200013
+
+# the TransferSyntaxUID tag, (0002,0010)
+TRANSFER_SYNTAX_UID_TAG = 0x00020010
+
+# maximum number of reads that are submitted to io_uring at once
+IO_URING_QUEUE_DEPTH = 256
+
 
-def write_nifti(filename, vol, affine):
+def write_nifti(filename, vol, affine, pigz=False, slope=1.0, inter=0.0):
     """Write a nifti file with an affine matrix.
+
+    The slope and inter are stored in the header as scl_slope and
+    scl_inter, so that readers get the values vol*slope + inter.
+
+    The volume can be a view (e.g. flipped by convert_coords), since
+    nibabel copies the data one slice at a time as it writes the file.
+    If pigz is set and the pigz program is available, a ".nii.gz" file
+    is written uncompressed and then compressed by pigz (in parallel).
     """
-    output = nib.Nifti1Image(vol.T, affine)
+    output = nib.Nifti1Image(vol.T, affine.astype(np.float64))
+    output.header.set_slope_inter(slope, inter)
+    if pigz and filename.endswith(".gz"):
+        if shutil.which("pigz"):
+            nib.save(output, filename[:-3])
+            subprocess.run(["pigz", "-1", "-f", filename[:-3]], check=True)
+            return
+        sys.stderr.write("pigz not found, using nibabel compression.\n")
     nib.save(output, filename)
 
 
-def create_affine(ipp, iop, ps):
-    """Generate a NIFTI affine matrix from DICOM IPP and IOP attributes.
+def use_numba():
+    """Check whether the affine matrices will be computed with numba.
+    """
+    return (bool(os.environ.get("DICOM_USE_NUMBA")) and
+            _numba() is not None)
 
-    The ipp (ImagePositionPatient) parameter should an Nx3 array, and
-    the iop (ImageOrientationPatient) parameter should be Nx6, where
-    N is the number of DICOM slices in the series.
 
-    The return values are the NIFTI affine matrix and the NIFTI pixdim.
-    Note the the output will use DICOM anatomical coordinates:
-    x increases towards the left, y increases towards the back.
+@functools.lru_cache(maxsize=None)
+def _numba():
+    """Import numba, or return None if numba is not available.
+
+    This is done when numba is first needed rather than at the top,
+    since importing numba is slow and every worker process pays for it.
     """
-    
-    # solve Ax = b where x is slope, intecept
+    try:
+        import numba
+    except ImportError:
+        return None
+    return numba
+
+
+def _njit(func):
+    """Compile a function with numba when it is first called.
+
+    If numba is not available, the function is called as it is.
+    """
+    @functools.lru_cache(maxsize=None)
+    def compiled():
+        numba = _numba()
+        if numba is None:
+            return func
+        return numba.njit(cache=True, fastmath=True)(func)
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        return compiled()(*args)
+
+    return wrapper
+
+
+@_njit
+def _create_affine_core(ipp, iop, ps):
+    """Compute the affine matrix and pixdim for create_affine().
+
+    This also returns the dot product of the slice vector with the
+    normal of the iop vectors, for the orthogonality check.  The inputs
+    and outputs are float32, but the sums are accumulated in float64.
+    """
+    # solve Ax = b where x is slope, intercept and A is [k, 1], using
+    # the normal equations with k centered on its mean, for which
+    # slope = sum(kc*(b - b_mean))/sum(kc*kc) and
+    # intercept = b_mean - slope*k_mean
     n = ipp.shape[0]
-    A = np.column_stack([np.arange(n), np.ones(n)])
-    x, r, rank, s = np.linalg.lstsq(A, ipp, rcond=None)
-    # round small values to zero
-    x[(np.abs(x) < 1e-6)] = 0.0
-    vec = x[0,:] # slope
-    pos = x[1,:] # intercept
+    k_mean = (n - 1)/2.0
+    denom = n*(n*n - 1)/12.0 # sum(kc*kc)
 
-    # pixel spacing should be the same for all image
-    spacing = np.ones(3)
-    spacing[0:2] = ps[0,:]
-    if np.sum(np.abs(ps - spacing[0:2])) > spacing[0]*1e-6:
-        sys.stderr.write("Pixel spacing is inconsistent!\n");
+    vec = np.zeros(3) # slope
+    pos = np.zeros(3) # intercept
+    for j in range(3):
+        b_mean = 0.0
+        for k in range(n):
+            b_mean += float(ipp[k,j])
+        b_mean /= n
+        sum_kb = 0.0
+        for k in range(n):
+            sum_kb += (k - k_mean)*(float(ipp[k,j]) - b_mean)
+        if denom != 0.0:
+            vec[j] = sum_kb/denom
+        pos[j] = b_mean - vec[j]*k_mean
+        # round small values to zero
+        if abs(vec[j]) < 1e-6:
+            vec[j] = 0.0
+        if abs(pos[j]) < 1e-6:
+            pos[j] = 0.0
 
+    # pixel spacing should be the same for all image, and
     # compute slice spacing
-    spacing[2] = np.round(np.sqrt(np.sum(np.square(vec))), 7)
+    spacing = np.ones(3)
+    spacing[0] = ps[0,0]
+    spacing[1] = ps[0,1]
+    spacing[2] = round(np.sqrt(vec[0]*vec[0] + vec[1]*vec[1] +
+                               vec[2]*vec[2]), 7)
 
     # get the orientation
-    iop_average = np.mean(iop, axis=0)
-    u = iop_average[0:3]
-    u /= np.sqrt(np.sum(np.square(u)))
-    v = iop_average[3:6]
-    v /= np.sqrt(np.sum(np.square(v)))
+    u = np.zeros(3)
+    v = np.zeros(3)
+    for k in range(n):
+        for j in range(3):
+            u[j] += iop[k,j]
+            v[j] += iop[k,j+3]
+    u /= np.sqrt(u[0]*u[0] + u[1]*u[1] + u[2]*u[2])
+    v /= np.sqrt(v[0]*v[0] + v[1]*v[1] + v[2]*v[2])
 
     # round small values to zero
-    u[(np.abs(u) < 1e-6)] = 0.0
-    v[(np.abs(v) < 1e-6)] = 0.0
+    for j in range(3):
+        if abs(u[j]) < 1e-6:
+            u[j] = 0.0
+        if abs(v[j]) < 1e-6:
+            v[j] = 0.0
 
     # create the matrix
-    mat = np.eye(4)
+    mat = np.eye(4, dtype=np.float32)
+    for j in range(3):
+        mat[j,0] = u[j]*spacing[0]
+        mat[j,1] = v[j]*spacing[1]
+        mat[j,2] = vec[j]
+        mat[j,3] = pos[j]
+
+    # dot product of slice vec with the cross product of iop vectors
+    cx = u[1]*v[2] - u[2]*v[1]
+    cy = u[2]*v[0] - u[0]*v[2]
+    cz = u[0]*v[1] - u[1]*v[0]
+    dv = vec[0]*cx + vec[1]*cy + vec[2]*cz
+    # qfac must be +1 or -1 for nifti, even if dv is zero
+    qfac = 1.0 if dv >= 0.0 else -1.0
+
+    # compute the nifti pixdim array
+    pixdim = np.empty(4, dtype=np.float32)
+    pixdim[0] = qfac
+    pixdim[1:4] = spacing
+
+    return mat, pixdim, dv
+
+
+def _create_affine_numpy(ipp, iop, ps):
+    """Compute the same values as _create_affine_core(), with numpy.
+
+    This is the default, since it is faster than _create_affine_core()
+    unless the cost of importing numba is spread over many series (and
+    the scalar loops of _create_affine_core() are slow without numba).
+    """
+    # the same centered normal equations as in _create_affine_core()
+    n = ipp.shape[0]
+    k_mean = (n - 1)/2.0
+    denom = n*(n*n - 1)/12.0 # sum(kc*kc)
+
+    b = ipp.astype(np.float64)
+    b_mean = b.mean(axis=0)
+    kc = np.arange(n) - k_mean
+    vec = np.zeros(3) # slope
+    if denom != 0.0:
+        vec = kc.dot(b - b_mean)/denom
+    pos = b_mean - vec*k_mean # intercept
+    # round small values to zero
+    vec[np.abs(vec) < 1e-6] = 0.0
+    pos[np.abs(pos) < 1e-6] = 0.0
+
+    # pixel spacing and slice spacing
+    spacing = np.ones(3)
+    spacing[0:2] = ps[0,:]
+    spacing[2] = round(float(np.sqrt(vec.dot(vec))), 7)
+
+    # get the orientation
+    uv = iop.sum(axis=0, dtype=np.float64)
+    u = uv[0:3]/np.sqrt(uv[0:3].dot(uv[0:3]))
+    v = uv[3:6]/np.sqrt(uv[3:6].dot(uv[3:6]))
+    u[np.abs(u) < 1e-6] = 0.0
+    v[np.abs(v) < 1e-6] = 0.0
+
+    # create the matrix
+    mat = np.eye(4, dtype=np.float32)
     mat[0:3,0] = u*spacing[0]
     mat[0:3,1] = v*spacing[1]
     mat[0:3,2] = vec
     mat[0:3,3] = pos
 
-    # check whether slice vec is orthogonal to iop vectors
-    dv = np.dot(vec, np.cross(u, v))
-    qfac = np.sign(dv)
-    if np.abs(qfac*dv - spacing[2]) > 1e-6:
-        sys.stderr.write("Non-orthogonal volume!\n");
+    # dot product of slice vec with the cross product of iop vectors
+    dv = float(vec.dot(np.cross(u, v)))
+    # qfac must be +1 or -1 for nifti, even if dv is zero
+    qfac = 1.0 if dv >= 0.0 else -1.0
 
     # compute the nifti pixdim array
-    pixdim = np.hstack([np.array(qfac), spacing])
+    pixdim = np.empty(4, dtype=np.float32)
+    pixdim[0] = qfac
+    pixdim[1:4] = spacing
+
+    return mat, pixdim, dv
+
+
+def create_affine(ipp, iop, ps, thickness=1.0):
+    """Generate a NIFTI affine matrix from DICOM IPP and IOP attributes.
+
+    The ipp (ImagePositionPatient) parameter should an Nx3 array, and
+    the iop (ImageOrientationPatient) parameter should be Nx6, where
+    N is the number of DICOM slices in the series.
+    If there is only one slice, the slice vector is the normal of the
+    iop vectors times the thickness (SliceThickness).
+
+    The return values are the NIFTI affine matrix and the NIFTI pixdim,
+    both as float32 arrays.
+    Note the the output will use DICOM anatomical coordinates:
+    x increases towards the left, y increases towards the back.
+    """
+    ipp = np.ascontiguousarray(ipp, dtype=np.float32)
+    iop = np.ascontiguousarray(iop, dtype=np.float32)
+    ps = np.ascontiguousarray(ps, dtype=np.float32)
+
+    if use_numba():
+        mat, pixdim, dv = _create_affine_core(ipp, iop, ps)
+    else:
+        mat, pixdim, dv = _create_affine_numpy(ipp, iop, ps)
+
+    if ipp.shape[0] == 1:
+        # a single slice has no slice vector, so use the normal of
+        # the (already normalized) iop vectors
+        if not thickness > 0.0:
+            thickness = 1.0
+        normal = np.cross(mat[0:3,0]/pixdim[1], mat[0:3,1]/pixdim[2])
+        mat[0:3,2] = normal*thickness
+        pixdim[0] = 1.0
+        pixdim[3] = thickness
+        dv = thickness
+
+    # pixel spacing should be the same for all image
+    if np.sum(np.abs(ps - ps[0,:])) > ps[0,0]*1e-6:
+        sys.stderr.write("Pixel spacing is inconsistent!\n");
+
+    # check whether slice vec is orthogonal to iop vectors
+    if np.abs(pixdim[0]*dv - pixdim[3]) > 1e-6:
+        sys.stderr.write("Non-orthogonal volume!\n");
 
     return mat, pixdim
 
@@ -104,15 +321,13 @@ def convert_coords(vol, mat):
 
     For DICOM, x increases to the left and y increases to the back.
     For NIFTI, x increases to the right and y increases to the front.
-    The conversion is done in-place (volume and matrix are modified).
+    The matrix is modified in-place.  The volume is not modified, any
+    flips are done with views, so the voxels are only reordered when
+    the volume is written.  The return value is (volume, matrix).
     """
-    # the x direction and y direction are flipped
-    convmat = np.eye(4)
-    convmat[0,0] = -1.0
-    convmat[1,1] = -1.0
-
-    # apply the coordinate change to the matrix
-    mat[:] = np.dot(convmat, mat)
+    # the x direction and y direction are flipped, i.e. the matrix is
+    # multiplied by diag(-1, -1, 1, 1)
+    mat[0:2,:] = -mat[0:2,:]
 
     # look for x and y elements with greatest magnitude
     xabs = np.abs(mat[:,0])
@@ -126,17 +341,20 @@ def convert_coords(vol, mat):
     # software that displays the image ignores the matrix).
     if mat[xmaxi,0] < 0.0:
         # flip x
-        vol[:] = np.flip(vol, 2)
+        vol = np.flip(vol, 2)
         mat[:,3] += mat[:,0]*(vol.shape[2] - 1)
         mat[:,0] = -mat[:,0]
     if mat[ymaxi,1] < 0.0:
         # flip y
-        vol[:] = np.flip(vol, 1)
+        vol = np.flip(vol, 1)
         mat[:,3] += mat[:,1]*(vol.shape[1] - 1)
         mat[:,1] = -mat[:,1]
 
-    # eliminate "-0.0" (negative zero) in the matrix
-    mat[mat == 0.0] = 0.0
+    # eliminate "-0.0" (negative zero) in the matrix, since -0.0 + 0.0
+    # is 0.0 in IEEE arithmetic
+    mat += 0.0
+
+    return vol, mat
 
 
 # Need to mofify the function to accept a list of files
@@ -144,17 +362,16 @@ def find_dicom_files(path):
     """Search for DICOM files at the provided location.
     """
     if os.path.isdir(path):
+        # scan the directory once, for both of the checks below
+        with os.scandir(path) as entries:
+            contents = [e for e in entries if not e.name.startswith(".")]
         # check for common DICOM suffixes
-        for ext in ("*.dcm", "*.DCM", "*.dc", "*.DC", "*.IMG"):
-            pattern = os.path.join(path, ext)
-            files = glob.glob(pattern)
-            if files:
-                break
+        files = [e.path for e in contents
+                 if os.path.splitext(e.name)[1].lower() in DICOM_SUFFIXES]
         # if no files with DICOM suffix are found, get all files
+        # (is_file() uses the file type from the scan, without a stat)
         if not files:
-            pattern = os.path.join(path, "*")
-            contents = glob.glob(pattern)
-            files = [f for f in contents if os.path.isfile(f)]
+            files = [e.path for e in contents if e.is_file()]
     elif os.path.isfile(path):
         # if 'path' is a file (not a folder), return the file
         # files = [args.input]
@@ -166,23 +383,88 @@ def find_dicom_files(path):
     return files
 
 
+def use_io_uring():
+    """Check whether files will be read with io_uring.
+    """
+    return (liburing is not None and
+            bool(os.environ.get("DICOM_USE_IO_URING")))
+
+
+def read_files_iouring(paths, queue_depth=IO_URING_QUEUE_DEPTH):
+    """Read a list of files into memory with batched io_uring reads.
+
+    The reads for up to 'queue_depth' files are submitted together, so
+    that the whole batch costs a single system call.  The return value
+    is a list of bytearrays, in the same order as the paths.
+    """
+    buffers = [None]*len(paths)
+    ring = liburing.Ring()
+    cqe = liburing.Cqe()
+    liburing.io_uring_queue_init(queue_depth, ring)
+    try:
+        for start in range(0, len(paths), queue_depth):
+            batch = range(start, min(start + queue_depth, len(paths)))
+            fds = []
+            try:
+                # queue one read per file, into a buffer of the file's size
+                for i in batch:
+                    fd = os.open(paths[i], os.O_RDONLY)
+                    fds.append(fd)
+                    buffers[i] = bytearray(os.fstat(fd).st_size)
+                    sqe = liburing.io_uring_get_sqe(ring)
+                    liburing.io_uring_prep_read(sqe, fd, buffers[i], 0)
+                    liburing.io_uring_sqe_set_data64(sqe, i)
+                liburing.io_uring_submit(ring)
+
+                # reap the completions, which can arrive in any order
+                for _ in batch:
+                    liburing.io_uring_wait_cqe(ring, cqe)
+                    entry = cqe[0]
+                    i = entry.user_data
+                    nbytes = liburing.trap_error(entry.res)
+                    liburing.io_uring_cqe_seen(ring, entry)
+                    if nbytes < len(buffers[i]):
+                        # finish a short read the ordinary way
+                        with open(paths[i], "rb") as f:
+                            f.seek(nbytes)
+                            buffers[i][nbytes:] = f.read()
+            finally:
+                for fd in fds:
+                    os.close(fd)
+    finally:
+        liburing.io_uring_queue_exit(ring)
+
+    return buffers
+
+
 def load_dicom_series(files):
     """Load a series of dicom files and return a list of datasets.
 
-    The resulting list will be sorted by InstanceNumber.
+    When io_uring is in use, the files are read into memory in batches
+    and the full datasets are parsed from memory, each file's buffer is
+    released as soon as it has been parsed.  Otherwise only the
+    headers are read (the pixel data is skipped), the pixels are read
+    later by dicom_to_volume().  The resulting list will be sorted by
+    InstanceNumber.
     """
-    # start by sorting filenames lexically
-    sorted_files = sorted(files)
+    if use_io_uring():
+        buffers = read_files_iouring(files)
+        datasets = []
+        for i in range(len(buffers)):
+            ds = pydicom.dcmread(io.BytesIO(buffers[i]))
+            # the dataset has its own copy of every value, including the
+            # PixelData, so neither the BytesIO nor the bytearray is needed
+            ds.buffer = None
+            buffers[i] = None
+            datasets.append(ds)
+    else:
+        datasets = [pydicom.dcmread(f, stop_before_pixels=True,
+                                    defer_size="1 KB") for f in files]
 
     # create list of tuples (InstanceNumber, DataSet)
     dataset_list = []
-    for f in files:
-        ds = pydicom.dcmread(f)
-        try:
-            i = int(ds.InstanceNumber)
-        except (AttributeError, ValueError):
-            i = -1
-        dataset_list.append( (i, ds) )
+    for ds in datasets:
+        dataset_list.append( (_instance_number(ds), ds) )
 
     # sort by InstanceNumber (the first element of each tuple)
     dataset_list.sort(key=lambda t: t[0])
@@ -193,51 +475,508 @@ def load_dicom_series(files):
     return series
 
 
-def dicom_to_volume(dicom_series):
-    """Convert a DICOM series into a float32 volume with orientation.
+def _instance_number(ds):
+    """Get the InstanceNumber of a dataset, or -1 if it is not valid.
+    """
+    try:
+        return int(ds.InstanceNumber)
+    except (AttributeError, ValueError, TypeError):
+        # TypeError is for an empty InstanceNumber, which is None
+        return -1
+
 
-    The input should be a list of 'dataset' objects from pydicom.
-    The output is a tuple (voxel_array, voxel_spacing, affine_matrix)
+def _past_instance_number(tag, vr, length):
+    """Stop condition: true for any tag after InstanceNumber.
+    """
+    return tag > INSTANCE_NUMBER_TAG
+
+
+def _read_transfer_syntax(fp):
+    """Read the file meta information and return its TransferSyntaxUID.
+
+    The file must be positioned just after the preamble.  The meta group
+    always starts with its group length (0002,0000) as explicit VR little
+    endian, so the group is read as one block and the file is left at
+    the start of the dataset.
+    """
+    head = fp.read(12)
+    if len(head) != 12 or head[0:6] != b"\x02\x00\x00\x00UL":
+        raise ValueError("No file meta group length")
+    group_length = int.from_bytes(head[8:12], "little")
+    meta = io.BytesIO(fp.read(group_length))
+    for elem in pydicom.filereader.data_element_generator(
+            meta, False, True, specific_tags=[TRANSFER_SYNTAX_UID_TAG]):
+        if elem.tag == TRANSFER_SYNTAX_UID_TAG:
+            return pydicom.uid.UID(elem.value.decode("ascii").strip(" \x00"))
+    raise ValueError("No TransferSyntaxUID")
+
+
+def fast_instance_number(path):
+    """Get the InstanceNumber of a DICOM file by reading its start.
+
+    After the preamble and the file meta information, the elements are
+    read only until tag (0020,0013) has been passed, and the values of
+    the other elements are skipped.  If the file cannot be read this
+    way, the header is read with dcmread() instead.  The return value
+    is -1 if the file has no valid InstanceNumber.
     """
-    # Create numpy arrays for volume, pixel spacing (ps),
+    try:
+        with open(path, "rb") as fp:
+            pydicom.filereader.read_preamble(fp, False)
+            syntax = _read_transfer_syntax(fp)
+            if syntax.is_deflated:
+                raise ValueError("Deflated transfer syntax")
+            for elem in pydicom.filereader.data_element_generator(
+                    fp, syntax.is_implicit_VR, syntax.is_little_endian,
+                    stop_when=_past_instance_number,
+                    specific_tags=[INSTANCE_NUMBER_TAG]):
+                if elem.tag == INSTANCE_NUMBER_TAG:
+                    # the raw value of an empty element is None
+                    if elem.value is None:
+                        return -1
+                    return int(elem.value)
+            return -1
+    except (pydicom.errors.InvalidDicomError, AttributeError, ValueError,
+            KeyError, EOFError):
+        pass
+
+    ds = pydicom.dcmread(path, stop_before_pixels=True,
+                         specific_tags=["InstanceNumber"])
+    return _instance_number(ds)
+
+
+def sort_dicom_files(files):
+    """Sort a list of DICOM files by InstanceNumber.
+
+    This only reads the start of each file (see fast_instance_number),
+    for when the file names are needed in order rather than the
+    datasets.
+    """
+    return sorted(files, key=fast_instance_number)
+
+
+@functools.lru_cache(maxsize=None)
+def _make_decoder(rows, cols, bits_allocated, bits_stored, signed):
+    """Make a function that decodes uncompressed little-endian pixels.
+
+    The function takes the PixelData bytes of one slice and returns a
+    rows x cols array, like pydicom's pixel_array but without its
+    per-call checks.  As in pydicom, the unused high bits are masked
+    off (unsigned) or filled with the sign bit (signed).
+    """
+    dtype = np.dtype("<%s%d" % ("i" if signed else "u", bits_allocated//8))
+    count = rows*cols
+    shift = bits_allocated - bits_stored
+    mask = (1 << bits_stored) - 1
+
+    def decode(pixel_data):
+        image = np.frombuffer(pixel_data, dtype=dtype, count=count)
+        if shift > 0:
+            if signed:
+                image = (image << shift) >> shift
+            else:
+                image = image & mask
+        return image.reshape(rows, cols)
+
+    return decode
+
+
+def _series_decoder(ds):
+    """Get the pixel decoder for a series, given its first dataset.
+
+    Returns None if the pixel data has to be decoded by pydicom, e.g.
+    if the transfer syntax is compressed.
+    """
+    try:
+        syntax = ds.file_meta.TransferSyntaxUID
+        if (syntax.is_compressed or syntax.is_deflated or
+                not syntax.is_little_endian):
+            return None
+        if (ds.SamplesPerPixel != 1 or
+                int(ds.get("NumberOfFrames", 1) or 1) != 1 or
+                ds.BitsAllocated not in (8, 16, 32) or
+                not 0 < ds.BitsStored <= ds.BitsAllocated):
+            return None
+        return _make_decoder(ds.Rows, ds.Columns, ds.BitsAllocated,
+                             ds.BitsStored, ds.PixelRepresentation == 1)
+    except (AttributeError, ValueError):
+        return None
+
+
+def _read_pixels(ds, decoder=None):
+    """Get the pixel array for a dataset, reading the file if needed.
+
+    Datasets from load_dicom_series() contain only the header, so the
+    file is opened a second time to decode the pixel data.  If a decoder
+    from _series_decoder() is given, it is used instead of pixel_array.
+    """
+    if "PixelData" not in ds:
+        ds = pydicom.dcmread(ds.filename)
+    if decoder is not None:
+        return decoder(ds.PixelData)
+    return ds.pixel_array
+
+
+def _get_float(ds, keyword, default):
+    """Get a float-valued attribute from a dataset, or a default value.
+    """
+    try:
+        return float(getattr(ds, keyword))
+    except (AttributeError, ValueError):
+        return default
+
+
+def fast_ds(ds, keyword):
+    """Get a DS (decimal string) attribute as a float64 array.
+
+    If pydicom has not converted the element yet, its raw bytes are
+    parsed directly by numpy, instead of creating one DSfloat per value.
+    """
+    tag = pydicom.datadict.tag_for_keyword(keyword)
+    if tag not in ds:
+        raise AttributeError(keyword)
+    value = ds.get_item(tag).value
+    if isinstance(value, bytes):
+        return np.fromstring(value.decode("ascii").strip(" \x00"),
+                             dtype=np.float64, sep="\\")
+    return np.array(value, dtype=np.float64, ndmin=1)
+
+
+def _series_metadata(dicom_series):
+    """Get the geometry and rescale parameters of a DICOM series.
+
+    The return value is a tuple (ps, ipp, iop, slopes, intercepts)
+    with one row (or value) per slice.
+    """
+    # Create numpy arrays for pixel spacing (ps),
     # slice position (ipp or ImagePositinPatient), and
     # slice orientation (iop or ImageOrientationPatient)
     n = len(dicom_series)
-    shape = (n,) + dicom_series[0].pixel_array.shape
-    vol = np.empty(shape, dtype=np.float32)
-    ps = np.empty((n,2), dtype=np.float64)
-    ipp = np.empty((n,3), dtype=np.float64)
-    iop = np.empty((n,6), dtype=np.float64)
-
-    for i, ds in enumerate(dicom_series):
-        # create a single complex-valued image from real,imag
-        image = ds.pixel_array
-        try:
-            slope = float(ds.RescaleSlope)
-        except (AttributeError, ValueError):
-            slope = 1.0
-        try:
-            intercept = float(ds.RescaleIntercept)
-        except (AttributeError, ValueError):
-            intercept = 0.0
-        
-        vol[i,:,:] = image*slope + intercept
-        ps[i,:] = dicom_series[i].PixelSpacing
-        ipp[i,:] = dicom_series[i].ImagePositionPatient
-        iop[i,:] = dicom_series[i].ImageOrientationPatient
+    ps = np.array([fast_ds(ds, "PixelSpacing") for ds in dicom_series],
+                  dtype=np.float32)
+    ipp = np.array([fast_ds(ds, "ImagePositionPatient")
+                    for ds in dicom_series], dtype=np.float32)
+    iop = np.array([fast_ds(ds, "ImageOrientationPatient")
+                    for ds in dicom_series], dtype=np.float32)
+
+    # per-slice rescale parameters
+    slopes = np.fromiter(
+        (_get_float(ds, "RescaleSlope", 1.0) for ds in dicom_series),
+        dtype=np.float32, count=n)
+    intercepts = np.fromiter(
+        (_get_float(ds, "RescaleIntercept", 0.0) for ds in dicom_series),
+        dtype=np.float32, count=n)
+
+    return ps, ipp, iop, slopes, intercepts
+
+
+def dicom_to_volume(dicom_series, max_workers=None):
+    """Convert a DICOM series into a volume with orientation.
+
+    The input should be a list of 'dataset' objects from pydicom.
+    If the datasets do not contain the pixel data, the files will be
+    read with a pool of 'max_workers' threads.
+    The output is a tuple (voxel_array, voxel_spacing, affine_matrix,
+    rescale), where rescale is the (slope, intercept) that still has to
+    be applied to the voxel_array.  If all slices have the same rescale,
+    the voxel_array keeps the stored pixel type (e.g. int16), otherwise
+    it is rescaled to float32 and the rescale is (1.0, 0.0).
+    """
+    ps, ipp, iop, slopes, intercepts = _series_metadata(dicom_series)
+    thickness = _get_float(dicom_series[0], "SliceThickness", 1.0)
+
+    # all slices share the decoder for the shape and type of the first
+    # slice, unless the slices differ in shape or type
+    decoder = _series_decoder(dicom_series[0])
+    if decoder is not None:
+        first = dicom_series[0]
+        layout = (first.Rows, first.Columns, first.BitsAllocated,
+                  first.BitsStored, first.PixelRepresentation,
+                  first.file_meta.TransferSyntaxUID)
+        for ds in dicom_series:
+            if (ds.Rows, ds.Columns, ds.BitsAllocated, ds.BitsStored,
+                    ds.PixelRepresentation,
+                    ds.file_meta.TransferSyntaxUID) != layout:
+                decoder = None
+                break
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        vol = np.stack(list(executor.map(_read_pixels, dicom_series,
+                                         [decoder]*len(dicom_series))))
+
+    if np.all(slopes == slopes[0]) and np.all(intercepts == intercepts[0]):
+        # keep the stored values, the rescale goes in the nifti header
+        rescale = (float(slopes[0]), float(intercepts[0]))
+    else:
+        # rescale in a single pass, computing directly in float32
+        # to avoid a float64 temporary for each slice
+        vol = np.multiply(vol, slopes[:,None,None], dtype=np.float32)
+        vol += intercepts[:,None,None]
+        rescale = (1.0, 0.0)
+
+    # create nibabel-style affine matrix and pixdim
+    # (these give DICOM LPS coords, not NIFTI RAS coords)
+    affine, pixdim = create_affine(ipp, iop, ps, thickness)
+    return vol, pixdim, affine, rescale
+
+
+@functools.lru_cache(maxsize=None)
+def _gpu_rescale_kernel(signed):
+    """Get the cupy kernel that applies the rescale slope and intercept.
+
+    As in _make_decoder(), the unused high bits are first filled with
+    the sign bit (signed) or masked off (unsigned), so the kernel takes
+    either the shift (signed) or the mask (unsigned) as its second
+    parameter.
+    """
+    import cupy
+    if signed:
+        return cupy.ElementwiseKernel(
+            "T x, int32 shift, float32 slope, float32 intercept",
+            "float32 y",
+            "T s = (T)(x << shift) >> shift; y = s*slope + intercept",
+            "dicom_rescale_signed")
+    return cupy.ElementwiseKernel(
+        "T x, T mask, float32 slope, float32 intercept",
+        "float32 y",
+        "T s = x & mask; y = s*slope + intercept",
+        "dicom_rescale_unsigned")
+
+
+def dicom_to_volume_gpu(series_paths):
+    """Convert a DICOM series into a float32 volume on the GPU.
+
+    The input should be a list of DICOM files, in any order, since
+    their headers are sorted by InstanceNumber after they are read.
+    The pixel data must be uncompressed, it is read from each file
+    directly into GPU memory with kvikio (GPUDirect Storage, if it is
+    available).  The output is a tuple (voxel_array, voxel_spacing,
+    affine_matrix), where voxel_array is a cupy array.
+    """
+    # these are imported here rather than at the top, since importing
+    # cupy is slow and only this function needs it
+    try:
+        import cupy
+        import kvikio
+    except ImportError:
+        raise ImportError("dicom_to_volume_gpu() requires cupy and kvikio")
+
+    # read the headers, deferring the pixel data so that its offset
+    # within the file can be found without reading it
+    headers = [pydicom.dcmread(f, defer_size="1 KB") for f in series_paths]
+
+    # sort by InstanceNumber, as in load_dicom_series()
+    headers.sort(key=_instance_number)
+
+    # the same checks as in _series_decoder(), since the pixel data
+    # is read from the file as it is
+    first = headers[0]
+    syntax = first.file_meta.TransferSyntaxUID
+    if (syntax.is_compressed or syntax.is_deflated or
+            not syntax.is_little_endian):
+        raise ValueError("Cannot read %s pixel data on the GPU" % syntax.name)
+    if first.SamplesPerPixel != 1:
+        raise ValueError("Cannot read multi-sample pixel data on the GPU")
+    frames = int(first.get("NumberOfFrames", 1) or 1)
+    if frames != 1:
+        raise ValueError("Cannot read multi-frame pixel data on the GPU")
+    if (first.BitsAllocated not in (8, 16, 32) or
+            not 0 < first.BitsStored <= first.BitsAllocated):
+        raise ValueError("Cannot read %d-bit pixel data on the GPU" %
+                         first.BitsAllocated)
+
+    n = len(headers)
+    rows = first.Rows
+    cols = first.Columns
+    signed = first.PixelRepresentation == 1
+    layout = (syntax, first.SamplesPerPixel, frames, rows, cols,
+              first.BitsAllocated, first.BitsStored, signed)
+    dtype = np.dtype("%s%d" % ("i" if signed else "u",
+                               first.BitsAllocated//8))
+    nbytes = rows*cols*dtype.itemsize
+    # for the unused high bits, as in _make_decoder()
+    if signed:
+        bits = np.int32(first.BitsAllocated - first.BitsStored)
+    else:
+        bits = dtype.type((1 << first.BitsStored) - 1)
+
+    # read the pixels of every slice straight into one device buffer
+    raw = cupy.empty((n, rows, cols), dtype=dtype)
+    files = []
+    try:
+        reads = []
+        for i, ds in enumerate(headers):
+            path = ds.filename
+            if (ds.file_meta.TransferSyntaxUID, ds.SamplesPerPixel,
+                    int(ds.get("NumberOfFrames", 1) or 1), ds.Rows,
+                    ds.Columns, ds.BitsAllocated, ds.BitsStored,
+                    ds.PixelRepresentation == 1) != layout:
+                raise ValueError("Pixel layout is inconsistent in %s" % path)
+            offset = ds.get_item(0x7FE00010, keep_deferred=True).value_tell
+            files.append(kvikio.CuFile(path, "r"))
+            reads.append(files[-1].pread(raw[i], size=nbytes,
+                                         file_offset=offset))
+        for r in reads:
+            r.get()
+    finally:
+        for f in files:
+            f.close()
+
+    ps, ipp, iop, slopes, intercepts = _series_metadata(headers)
+    thickness = _get_float(first, "SliceThickness", 1.0)
+
+    # fix the unused bits and rescale on the device with a single
+    # elementwise kernel
+    vol = _gpu_rescale_kernel(signed)(raw, bits,
+                                      cupy.asarray(slopes)[:,None,None],
+                                      cupy.asarray(intercepts)[:,None,None])
 
     # create nibabel-style affine matrix and pixdim
     # (these give DICOM LPS coords, not NIFTI RAS coords)
-    affine, pixdim = create_affine(ipp, iop, ps)
+    affine, pixdim = create_affine(ipp, iop, ps, thickness)
     return vol, pixdim, affine
 
+def _index_patients(input_dir: str,
+                    template_json: List[str]) -> Dict[str, List[str]]:
+    """Map each patient id in the template to its study directories.
+
+    Each patient directory is scanned once, and its subdirectories are
+    sorted by name so that the "<patient id>_<index>" values in the
+    template always refer to the same study.
+    """
+    index = {}
+    for p_id in {value.split("_")[0] for value in template_json}:
+        try:
+            with os.scandir(os.path.join(input_dir, p_id)) as entries:
+                index[p_id] = sorted(e.path for e in entries
+                                     if e.is_dir() and
+                                     not e.name.startswith("."))
+        except OSError:
+            sys.stderr.write("Cannot open %s\n" % (p_id,))
+            index[p_id] = []
+    return index
+
+
+def _first_subdir(path: str) -> Optional[str]:
+    """Get the first subdirectory (by name) of a directory, or None.
+    """
+    with os.scandir(path) as entries:
+        return min((e.path for e in entries
+                    if e.is_dir() and not e.name.startswith(".")),
+                   default=None)
+
+
+def _load_one(value: str,
+              study_dir: str,
+              output_dir: str,
+              max_threads: int=None) -> Optional[tuple]:
+    """Load the DICOM series for one patient as a NIFTI-oriented volume.
+
+    The value is "<patient id>_<index>", as in the template json, and
+    the study_dir is the directory for that index (see _index_patients).
+    The pixels are read with up to max_threads threads.
+    Returns a tuple (output_file, vol, mat, slope, inter) with the
+    arguments for write_nifti(), or None on failure.
+    """
+    # find the path with the most DICOM files
+    p_id = value.split("_")[0]
+    index = value.split("_")[1]
+
+    dicom_path = _first_subdir(study_dir)
+    if dicom_path is None:
+        sys.stderr.write("No DICOM files found.\n")
+        return None
+
+    files = find_dicom_files(dicom_path)
+    if not files:
+        sys.stderr.write("No DICOM files found.\n")
+        return None
+
+    # load the files to create a list of slices
+    series = load_dicom_series(files)
+    if not series:
+        sys.stderr.write("Unable to read DICOM files.\n")
+        return None
+
+    # reconstruct the images into a volume
+    vol, pixdim, mat, (slope, inter) = dicom_to_volume(
+        series, max_workers=max_threads)
+
+    # convert DICOM coords to NIFTI coords (the matrix is modified
+    # in-place, the volume is returned as a flipped view)
+    vol, mat = convert_coords(vol, mat)
+
+    # write the file (note that the volume will be transposed so that the
+    # indices will be ordered the way that nibabel prefers: pixel,row,slice
+    # instead of slice,row,pixel)
+
+    # Needs to save the name of the patient to the output directory
+    output_file = os.path.join(output_dir, f"{p_id}_{index}.nii.gz")
+
+    return output_file, vol, mat, slope, inter
+
+
+def _convert_one(value: str,
+                 study_dir: str,
+                 output_dir: str,
+                 pigz: bool=False,
+                 max_threads: int=None) -> Optional[str]:
+    """Convert the DICOM series for one patient to a NIFTI file.
+
+    Returns the name of the output file, or None on failure.
+    """
+    loaded = _load_one(value, study_dir, output_dir, max_threads)
+    if loaded is None:
+        return None
+
+    output_file, vol, mat, slope, inter = loaded
+    write_nifti(output_file, vol, mat, pigz=pigz, slope=slope, inter=inter)
+
+    return output_file
+
+
+def _convert_pipelined(jobs: List[Tuple[str, str]],
+                       output_dir: str,
+                       pigz: bool=False) -> None:
+    """Convert the patients one after another in a single process.
+
+    The jobs are (value, study_dir) tuples, as for _load_one().
+
+    The files are written by a second thread, so that the next volume
+    is decoded while the previous one is compressed and written (zlib
+    and the pixel decoding both release the GIL).  At most two volumes
+    are kept in memory: the one being written and the one being decoded.
+    """
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        pending = collections.deque()
+        for value, study_dir in jobs:
+            loaded = _load_one(value, study_dir, output_dir)
+            if loaded is None:
+                continue
+            output_file, vol, mat, slope, inter = loaded
+            pending.append(writer.submit(write_nifti, output_file, vol, mat,
+                                         pigz=pigz, slope=slope, inter=inter))
+            # wait for the previous volume before decoding the next one
+            while len(pending) > 1:
+                pending.popleft().result()
+        for future in pending:
+            future.result()
+
+
 def dicom_to_nifti(input_dir: str,
                    output_dir: str="./data",
-                   template_json: List[str]=None) -> None:
+                   template_json: List[str]=None,
+                   max_workers: int=None,
+                   pigz: bool=False) -> None:
     """Convert DICOM files to NIFTI format.
     
     Takes in an input directory containing DICOM files and an output directory
-    to save the NIFTI files. 
+    to save the NIFTI files. Each patient is converted in a separate process,
+    with up to max_workers processes (default: the number of CPUs),
+    and the CPUs are shared among the processes for reading the pixels.
+    With max_workers=1, the patients are converted in this process, with
+    the decoding of each volume overlapped with writing the previous one.
+    If pigz is set, the files are compressed with pigz (see write_nifti).
     """
     
     # Goes through the input directory,
@@ -246,47 +985,62 @@ def dicom_to_nifti(input_dir: str,
     # glob.glob(input_dir/*) <- For find_dicom_files, it needs to be the root directory that contains all the DICOM files
     #TODO: create a function that will find the path of a specified patient id with the most DICOM files 
 
-    # create a list of the dicom files
-    
+    # scan each patient directory once, rather than once per value
+    index = _index_patients(input_dir, template_json)
+    jobs = []
     for value in template_json:
-        # find the path with the most DICOM files
         p_id = value.split("_")[0]
-        index = value.split("_")[1]
-        
-        dicom_path = glob.glob(f"{input_dir}/{p_id}/*")[index]
-        dicom_path = glob.glob(f"{dicom_path}/*")[0]
-    
-        files = find_dicom_files(dicom_path)
-        if not files:
-            sys.stderr.write("No DICOM files found.\n")
-            return
+        i = int(value.split("_")[1])
+        if i >= len(index[p_id]):
+            sys.stderr.write("No study %d for %s\n" % (i, p_id))
+            continue
+        jobs.append( (value, index[p_id][i]) )
 
-        # load the files to create a list of slices
-        series = load_dicom_series(files)
-        if not series:
-            sys.stderr.write("Unable to read DICOM files.\n")
-            return
+    if max_workers is None:
+        max_workers = os.cpu_count()
 
-        # reconstruct the images into a volume
-        vol, pixdim, mat = dicom_to_volume(series)
+    if max_workers == 1:
+        _convert_pipelined(jobs, output_dir, pigz)
+        return
 
-        # convert DICOM coords to NIFTI coords (in-place)
-        convert_coords(vol, mat)
+    # split the CPUs between the processes, rather than letting each
+    # process start its own full-size thread pool for reading pixels
+    max_threads = max(1, (os.cpu_count() or 1)//max_workers)
 
-        # write the file (note that the volume will be transposed so that the
-        # indices will be ordered the way that nibabel prefers: pixel,row,slice
-        # instead of slice,row,pixel)
-        
-        # Needs to save the name of the patient to the output directory
-        output_file = os.path.join(output_dir, f"{p_id}_{index}.nii.gz")
-        write_nifti(output_file, vol, mat)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_convert_one, value, study_dir, output_dir,
+                                   pigz, max_threads)
+                   for value, study_dir in jobs]
+        for future in as_completed(futures):
+            future.result()
         
 
+def _iter_nifti_files(root_path: str) -> Iterator[str]:
+    """Yield the paths of the NIFTI (.nii.gz) files in a directory.
+    """
+    with os.scandir(root_path) as entries:
+        for entry in entries:
+            if entry.name.endswith(".nii.gz") and not entry.name.startswith("."):
+                yield entry.path
+
+
+@functools.lru_cache(maxsize=8)
+def _list_nifti_files(root_path: str, mtime_ns: int) -> Tuple[str, ...]:
+    """List the NIFTI files in a directory, cached between calls.
+
+    The mtime_ns is the modification time of the directory, it is only
+    used as part of the cache key, so that the directory is scanned
+    again whenever a file is added or removed.
+    """
+    return tuple(_iter_nifti_files(root_path))
+
+
 def save_nifti_to_json(f_name:str, #
                        root_path: str="./data", 
                        save_path: str="./json", 
                        train_split:float=0.3, 
-                       shuffle:bool=True) -> dict:
+                       shuffle:bool=True,
+                       indent:Optional[int]=None) -> dict:
     
     """Converts the nii path to a JSON file
     
@@ -310,10 +1064,13 @@ def save_nifti_to_json(f_name:str, #
             ...
             ]
     }
+
+    The JSON is written without indentation unless indent is given.
+    The dataset dict is also returned.
     """
 
-    dataset = {"training": [], "validation": []}
-    nifti_files = glob.glob(f"{root_path}/*.nii.gz")
+    nifti_files = list(_list_nifti_files(root_path,
+                                         os.stat(root_path).st_mtime_ns))
     
     if shuffle:
         random.shuffle(nifti_files)
@@ -323,15 +1080,14 @@ def save_nifti_to_json(f_name:str, #
     train_imgs = nifti_files[:int(split)]
     val_imgs = nifti_files[int(split):]
     
-    for img in train_imgs:
-        dataset["training"].append({"image": img})
-    
-    for img in val_imgs:
-        dataset["validation"].append({"image": img})
+    dataset = {"training": [{"image": img} for img in train_imgs],
+               "validation": [{"image": img} for img in val_imgs]}
     
     # Save the dataset to a JSON file
     with open(os.path.join(save_path, f"{f_name}.json"), "w") as f:
-        json.dump(dataset, f, indent=4)
+        json.dump(dataset, f, indent=indent)
+
+    return dataset
     
     
     